@@ -43,7 +43,9 @@ parser.add_argument("--gen_qtd",    type=int,   default=1000,  help="How many sa
 parser.add_argument("--trunc",      type=float, default=0.95,   help="Truncation sigma")
 parser.add_argument("--trunc_mode", type=str,   default='w',   choices=['z', 'w', '-'], help="Truncation mode (check paper for details)")
 parser.add_argument("--mean_size",  type=int,   default=1000,  help="Samples to estimate mean")
+parser.add_argument("--compile",    action='store_true',       help="Compile the generator (needs torch>=2.2)")
 opt = parser.parse_args()
+if opt.compile and not hasattr(torch.nn.Module, 'compile'): parser.error("--compile needs torch>=2.2 (nn.Module.compile), found torch " + torch.__version__)
 print(opt)
 
 config_file = open(os.path.join(out,"gen_config.txt"),"w")
@@ -54,7 +56,7 @@ cuda = True if torch.cuda.is_available() else False
 print(cuda)
 
 # Initialize generator 
-generator     = Generator(opt.latent_dim, opt.channels, opt.n_classes, opt.t_size, mlp_dim=opt.mlp_dim, dataset=opt.dataset)
+generator     = Generator(opt.latent_dim, opt.channels, opt.n_classes, opt.t_size, mlp_dim=opt.mlp_dim, dataset=opt.dataset, compiled=opt.compile)
 
 if cuda:
     generator.cuda()
@@ -90,7 +92,8 @@ while(len(classes)>0):
     z         = trunc(z, opt.mean_size, opt.trunc) if opt.trunc_mode=='z' else z
     labels_np = np.array([num for _ in range(qtd) for num in classes])  # Generate labels
     labels    = Variable(LongTensor(labels_np))
-    gen_imgs  = generator(z, labels, opt.trunc) if opt.trunc_mode == 'w' else generator(z, labels)
+    with torch.no_grad():  # Inference only, lets the generator reuse its cached adjacencies and noise buffers
+        gen_imgs = generator(z, labels, opt.trunc) if opt.trunc_mode == 'w' else generator(z, labels)
 
     new_imgs   = gen_imgs.data.cpu()  if len(new_imgs)==0 else np.concatenate((new_imgs, gen_imgs.data.cpu()), axis=0)
     new_labels = labels_np if len(new_labels)==0 else np.concatenate((new_labels, labels_np), axis=0)
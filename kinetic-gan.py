@@ -40,7 +40,9 @@ parser.add_argument("--checkpoint_interval", type=int, default=10000, help="inte
 parser.add_argument("--dataset", type=str, default="ntu", help="dataset")
 parser.add_argument("--data_path", type=str, default="/media/degar/Data/PhD/Kinetic-GAN/Brito-pc/Degs/DATASETS/NTU/xsub/train_data.npy", help="path to data")
 parser.add_argument("--label_path", type=str, default="/media/degar/Data/PhD/Kinetic-GAN/Brito-pc/Degs/DATASETS/NTU/xsub/train_label.pkl", help="path to label")
+parser.add_argument("--compile", action='store_true', help="compile the generator (needs torch>=2.2)")
 opt = parser.parse_args()
+if opt.compile and not hasattr(torch.nn.Module, 'compile'): parser.error("--compile needs torch>=2.2 (nn.Module.compile), found torch " + torch.__version__)
 print(opt)
 
 # Save config file and respective generator and discriminator for reproducibilty
@@ -56,7 +58,7 @@ cuda = True if torch.cuda.is_available() else False
 print('CUDA',cuda)
 
 # Models initialization
-generator     = Generator(opt.latent_dim, opt.channels, opt.n_classes, opt.t_size, opt.mlp_dim, dataset=opt.dataset)
+generator     = Generator(opt.latent_dim, opt.channels, opt.n_classes, opt.t_size, opt.mlp_dim, dataset=opt.dataset, compiled=opt.compile)
 discriminator = Discriminator(opt.channels, opt.n_classes, opt.t_size, opt.latent_dim, dataset=opt.dataset)
 
 if cuda:
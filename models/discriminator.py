@@ -55,7 +55,7 @@ class Discriminator(nn.Module):
 
 
         c = self.label_emb(labels)
-        c = c.view(c.size(0), c.size(1), 1, 1).repeat(1, 1, T, V)
+        c = c.view(c.size(0), c.size(1), 1, 1).expand(-1, -1, T, V)  # Broadcast view, cat copies it once
 
         x = torch.cat((c, x), 1)
         
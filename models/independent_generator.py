@@ -1,8 +1,10 @@
 
+from functools import lru_cache
+from typing import Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 
 from .init_gan.tgcn import ConvTemporalGraphical
 from .init_gan.graph_ntu import graph_ntu
@@ -10,15 +12,46 @@ from .init_gan.graph_h36m import Graph_h36m
 import numpy as np
 
 
-class NoiseInjection(nn.Module):
+@lru_cache(maxsize=None)
+def _get_graph(dataset='ntu', max_hop=1, dilation=1):  # Graph coarsening is pure Python, build it once
+    return graph_ntu(max_hop, dilation) if dataset == 'ntu' else Graph_h36m(max_hop, dilation)
+
+
+@lru_cache(maxsize=None)
+def _get_adjacency(dataset='ntu', device="cpu"):  # All levels zero padded into one (L, K, V, V) tensor
+    As = _get_graph(dataset).As
+    A  = torch.zeros(len(As), *np.max([Al.shape for Al in As], 0), dtype=torch.float32)
+    for lvl, Al in enumerate(As):
+        A[lvl, :Al.shape[0], :Al.shape[1], :Al.shape[2]] = torch.tensor(Al, dtype=torch.float32)
+    return A if device == "cpu" else A.cuda()
+
+
+def _fused_act(x, res: Optional[torch.Tensor], weight, noise, tan: bool):  # Residual, noise injection and activation in one kernel
+    x = x if res is None else x + res
+    x = x + weight * noise
+    return torch.tanh(x) if tan else F.leaky_relu(x, 0.2)
+
+
+if not hasattr(torch, 'compile'):  # torch<2.0: script it for the fuser, newer releases deprecate jit.script and fuse it under --compile
+    _fused_act = torch.jit.script(_fused_act)
+
+
+def _autocast_dtype():  # Dtype the gcn einsum runs in under cuda autocast, None outside of it
+    if not torch.is_autocast_enabled():
+        return None
+    if hasattr(torch, 'get_autocast_dtype'):  # torch>=2.4, get_autocast_gpu_dtype is deprecated there
+        return torch.get_autocast_dtype('cuda')
+    if hasattr(torch, 'get_autocast_gpu_dtype'):
+        return torch.get_autocast_gpu_dtype()
+    return torch.float16  # torch<1.10 only autocasts to float16
+
+
+class NoiseInjection(nn.Module):  # Only holds the noise weight, st_gcn applies it in _fused_act
     def __init__(self, channel):
         super().__init__()
 
         self.weight = nn.Parameter(torch.zeros(1, channel, 1, 1))
 
-    def forward(self, image, noise):
-        return image + self.weight * noise
-
 
 class Mapping_Net(nn.Module):
     def __init__(self, latent=1024, mlp=4):
@@ -40,18 +73,15 @@ class Mapping_Net(nn.Module):
 
 class Generator(nn.Module):
     
-    def __init__(self, in_channels, out_channels, t_size, mlp_dim=4, edge_importance_weighting=True, dataset='ntu', device="cpu", **kwargs):
+    def __init__(self, in_channels, out_channels, t_size, mlp_dim=4, edge_importance_weighting=True, dataset='ntu', device="cpu", compiled=False, **kwargs):
         super().__init__()
         
         self.device = device
 
         # load graph
-        self.graph = graph_ntu() if dataset == 'ntu' else Graph_h36m()
-        
-        if device == "cpu":
-            self.A = [torch.tensor(Al, dtype=torch.float32, requires_grad=False) for Al in self.graph.As]
-        else:
-            self.A = [torch.tensor(Al, dtype=torch.float32, requires_grad=False).cuda() for Al in self.graph.As]
+        self.graph = _get_graph(dataset)
+        self.A_size = [Al.shape for Al in self.graph.As]
+        self.register_buffer('A_all', _get_adjacency(dataset, device).clone(), persistent=False)  # Own copy, follows model.to(device)
 
         # build networks
         spatial_kernel_size  = [A.size(0) for A in self.A]
@@ -78,33 +108,60 @@ class Generator(nn.Module):
             ])
         else:
             self.edge_importance = [1] * len(self.st_gcn_networks)
+
+        self._A_eff = None  # (key, importance weighted adjacencies), cached for inference
+
+        if compiled:  # Shapes are static once t_size and the batch size are fixed
+            if not hasattr(nn.Module, 'compile'):
+                raise RuntimeError('compiled=True needs torch>=2.2 (nn.Module.compile), found torch ' + torch.__version__)
+            self.compile(mode='reduce-overhead')  # In place, so state_dict keys and deepcopies stay per model
         
 
     def forward(self, x, trunc=None):
-        w = []
-        for i in x:
-            w = self.mlp(i).unsqueeze(0) if len(w)==0 else torch.cat((w, self.mlp(i).unsqueeze(0)), dim=0)
+        w = torch.stack([self.mlp(i) for i in x])  # One copy instead of growing w sample by sample
 
         w = self.truncate(w, 1000, trunc) if trunc is not None else w  # Truncation trick on W
 
         x = w.view((*w.shape, 1, 1))
 
         # forward
-        for gcn, importance in zip(self.st_gcn_networks, self.edge_importance):
-            x, _ = gcn(x, self.A[gcn.lvl] * importance)
+        return self.synthesis(x, self.weighted_A())
+
+    def synthesis(self, x, As):
+        for gcn, A in zip(self.st_gcn_networks, As):
+            x, _ = gcn(x, A)
 
         return x
 
+    @property
+    def A(self):  # Static per level views into the padded adjacency
+        return [self.A_all[lvl, :K, :V, :W] for lvl, (K, V, W) in enumerate(self.A_size)]
+
+    def weighted_A(self):
+        As = self.A  # The property slices every level, do it once
+
+        # Autograd has to see the product while training, otherwise it only changes with the weights
+        if self.training or torch.is_grad_enabled():
+            return [As[gcn.lvl] * importance for gcn, importance in zip(self.st_gcn_networks, self.edge_importance)]
+
+        # Under autocast keep them in the einsum dtype, so they are not cast again on every forward.
+        # Version counters catch any in-place update (optimizer, load_state_dict, EMA, init, ...)
+        dtype = _autocast_dtype()
+        key   = (dtype, self.A_all._version, tuple(getattr(p, '_version', 0) for p in self.edge_importance))
+        if self._A_eff is None or self._A_eff[0] != key:
+            self._A_eff = (key, [(As[gcn.lvl] * importance).to(dtype or self.A_all.dtype)
+                                 for gcn, importance in zip(self.st_gcn_networks, self.edge_importance)])
+
+        return self._A_eff[1]
+
+    def _apply(self, *args, **kwargs):  # .to(), .cuda(), .half(), ... replace the tensors and reset their versions
+        self._A_eff = None
+        return super()._apply(*args, **kwargs)
+
     def truncate(self, w, mean, truncation):  # Truncation trick on W
-        if self.device == "cpu":
-            t = Variable(torch.FloatTensor(np.random.normal(0, 1, (mean, *w.shape[1:]))))
-        else:
-            t = Variable(torch.cuda.FloatTensor(np.random.normal(0, 1, (mean, *w.shape[1:]))))
-            
-            
-        w_m = []
-        for i in t:
-            w_m = self.mlp(i).unsqueeze(0) if len(w_m)==0 else torch.cat((w_m, self.mlp(i).unsqueeze(0)), dim=0)
+        t = torch.randn(mean, *w.shape[1:], device=w.device, dtype=w.dtype)  # Follows the model's device
+
+        w_m = torch.stack([self.mlp(i) for i in t])
 
         m = w_m.mean(0, keepdim=True)
 
@@ -131,13 +188,17 @@ class st_gcn(nn.Module):
                 device="cpu"
                 ):
         super().__init__()
-        
-        self.device = device
 
         assert len(kernel_size) == 2
         assert kernel_size[0][lvl] % 2 == 1
         padding = ((kernel_size[0][lvl] - 1) // 2, 0)
         self.graph, self.lvl, self.up_s, self.up_t, self.tan = graph, lvl, up_s, up_t, tan
+
+        if up_s:
+            up_W = torch.tensor(graph.upsample[lvl])
+            up_W[:, [umap[0] for umap in graph.mapping[lvl]]] /= (2 if lvl==2 else 1)  # Inserted nodes only
+            self.register_buffer('up_W', up_W, persistent=False)
+
         self.gcn = ConvTemporalGraphical(in_channels, out_channels,
                                         kernel_size[1][lvl])
 
@@ -155,7 +216,7 @@ class st_gcn(nn.Module):
 
 
         if not residual:
-            self.residual = lambda x: 0
+            self.residual = lambda x: None
 
         elif (in_channels == out_channels) and (stride == 1):
             self.residual = lambda x: x
@@ -171,9 +232,7 @@ class st_gcn(nn.Module):
             )
 
         self.noise = NoiseInjection(out_channels)
-
-        self.l_relu = nn.LeakyReLU(0.2, inplace=True)
-        self.tanh   = nn.Tanh()
+        self.register_buffer('_noise_buf', torch.empty(0), persistent=False)
 
     def forward(self, x, A):
 
@@ -183,32 +242,24 @@ class st_gcn(nn.Module):
 
         res = self.residual(x)
         x, A = self.gcn(x, A)
-        x    = self.tcn(x) + res
+        x    = self.tcn(x)
         
         # Noise Inject
-        if self.device == "cpu":
-            noise = torch.randn(x.size(0), 1, x.size(2), x.size(3), device='cpu')
-        else:
-            noise = torch.randn(x.size(0), 1, x.size(2), x.size(3), device='cuda:0')
-            
-        x     = self.noise(x, noise)
+        noise = self.sample_noise(x)
 
-        return self.tanh(x) if self.tan else self.l_relu(x), A
+        return _fused_act(x, res, self.noise.weight, noise, self.tan), A
 
-    
-    def upsample_s(self, tensor):
+    def sample_noise(self, x):
+        shape = (x.size(0), 1, x.size(2), x.size(3))
 
-        ids  = []
-        mean = []
-        for umap in self.graph.mapping[self.lvl]:
-            ids.append(umap[0])
-            tmp = None
-            for nmap in umap[1:]:
-                tmp = torch.unsqueeze(tensor[:, :, :, nmap], -1) if tmp == None else torch.cat([tmp, torch.unsqueeze(tensor[:, :, :, nmap], -1)], -1)
+        # Autograd keeps the noise to compute the weight gradient, refilling it in place would corrupt it
+        if torch.is_grad_enabled() and self.noise.weight.requires_grad:
+            return torch.randn(shape, device=x.device, dtype=x.dtype)
 
-            mean.append(torch.unsqueeze(torch.mean(tmp, -1) / (2 if self.lvl==2 else 1), -1))
+        if self._noise_buf.shape != shape or self._noise_buf.device != x.device or self._noise_buf.dtype != x.dtype:
+            self._noise_buf = torch.empty(shape, device=x.device, dtype=x.dtype)
 
-        for i, idx in enumerate(ids): tensor = torch.cat([tensor[:,:,:,:idx], mean[i], tensor[:,:,:,idx:]], -1)
+        return self._noise_buf.normal_()
 
-
-        return tensor
+    def upsample_s(self, tensor):
+        return torch.einsum('nctv,vw->nctw', (tensor, self.up_W))
@@ -1,6 +1,7 @@
+from itertools import combinations
+
 import numpy as np
 import networkx as nx
-import matplotlib.pyplot as plt
 
 class Graph_h36m():
 
@@ -10,15 +11,13 @@ class Graph_h36m():
         self.max_hop  = max_hop
         self.dilation = dilation
         self.lvls     = 4  # 16 -> 7 -> 2 -> 1
-        self.As       = []
-        self.hop_dis  = []
 
-        self.get_edge()
-        for lvl in range(self.lvls):
-            self.hop_dis.append(get_hop_distance(self.num_node, self.edge, lvl, max_hop=max_hop))
-            self.get_adjacency(lvl)
+        self.get_edge()  # Each level is coarsened from the previous one, everything below is per level
+        self.hop_dis = [get_hop_distance(self.num_node, self.edge, lvl, max_hop=max_hop) for lvl in range(self.lvls)]
+        self.As      = [self.get_adjacency(lvl) for lvl in range(self.lvls)]
 
         self.mapping = upsample_mapping(self.map, self.nodes, self.edge, self.lvls)[::-1]
+        self.upsample = [upsample_matrix(self.mapping[lvl], self.num_node[lvl]) for lvl in range(self.lvls-1)]
 
     def __str__(self):
         return self.As
@@ -27,8 +26,6 @@ class Graph_h36m():
         self.num_node = []
         self.nodes = []
         self.center = [8]  # Thorax
-        self.nodes = []
-        self.Gs = []
         
         neighbor_link = [(1,2), (2,3), (0,1),
                          (4,5), (5,6), (0,4),
@@ -45,25 +42,24 @@ class Graph_h36m():
         self_link = [(int(i), int(i)) for i in G]
 
 
-        self.map = [np.array([[i, x] for i,x in enumerate(G)])]
-        self.edge = [np.concatenate((np.array(G.edges), self_link), axis=0)]
+        self.map = [np.array([[i, x] for i,x in enumerate(G)], dtype=np.int32)]
+        self.edge = [np.concatenate((np.array(G.edges), self_link), axis=0).astype(np.int32)]
         self.nodes.append(nodes)
         self.num_node.append(len(G))
-        self.Gs.append(G.copy())
 
         for _ in range(self.lvls-1):
-            stay  = []
+            stay  = set()
             start = 1
             while True:
                 remove = []
                 for i in G:
                     if i==9 and _==0: continue
-                    if len(G.edges(i)) == start and i not in stay:
+                    if G.degree(i) == start and i not in stay:
                         lost = []
                         for j,k in G.edges(i):
-                            stay.append(k)
+                            stay.add(k)
                             lost.append(k)
-                        recon = [(l,m) for l in lost for m in lost if l!=m]
+                        recon = combinations(lost, 2)  # Undirected graph, one edge per pair
                         G.add_edges_from(recon)            
                         remove.append(i)
 
@@ -78,7 +74,7 @@ class Graph_h36m():
 
                 start+=1
 
-            map_i = np.array([[i, x] for i,x in enumerate(G)])  # Keep track graph indices
+            map_i = np.array([[i, x] for i,x in enumerate(G)], dtype=np.int32)  # Keep track graph indices
             self.map.append(map_i)
 
             mapping = {}  # Change mapping labels
@@ -97,10 +93,9 @@ class Graph_h36m():
 
             self_link = [(int(i), int(i)) for i in G]
             
-            G_l = np.concatenate((np.array(G.edges), self_link), axis=0) if len(np.array(G.edges)) > 0 else self_link
-            self.edge.append(G_l)
+            G_l = np.asarray(list(G.edges), dtype=np.int32).reshape(-1, 2)  # (0, 2) once no edges are left
+            self.edge.append(np.concatenate((G_l, self_link), axis=0).astype(np.int32))
             self.num_node.append(len(G))
-            self.Gs.append(G.copy())
             
 
         assert len(self.num_node) == self.lvls
@@ -117,64 +112,61 @@ class Graph_h36m():
             adjacency[self.hop_dis[lvl] == hop] = 1
         normalize_adjacency = normalize_digraph(adjacency)
 
+        hop_dis = self.hop_dis[lvl]
+        center  = hop_dis[:, self.center[lvl]]
+        root    = center[:, None] == center[None, :]  # j and i equally far from the center
+        close   = center[:, None] >  center[None, :]  # j further from the center than i
+        further = ~(root | close)
+
         A = []
         for hop in valid_hop:
-            a_root = np.zeros((self.num_node[lvl], self.num_node[lvl]))
-            a_close = np.zeros((self.num_node[lvl], self.num_node[lvl]))
-            a_further = np.zeros((self.num_node[lvl], self.num_node[lvl]))
-            for i in range(self.num_node[lvl]):
-                for j in range(self.num_node[lvl]):
-                    if self.hop_dis[lvl][j, i] == hop:
-                        if self.hop_dis[lvl][j, self.center[lvl]] == self.hop_dis[lvl][i, self.center[lvl]]:
-                            a_root[j, i] = normalize_adjacency[j, i]
-                        elif self.hop_dis[lvl][j, self.center[lvl]] > self.hop_dis[lvl][i, self.center[lvl]]:
-                            a_close[j, i] = normalize_adjacency[j, i]
-                        else:
-                            a_further[j, i] = normalize_adjacency[j, i]
+            mask      = hop_dis == hop
+            a_root    = normalize_adjacency * (mask & root)
+            a_close   = normalize_adjacency * (mask & close)
+            a_further = normalize_adjacency * (mask & further)
             if hop == 0:
                 A.append(a_root)
             else:
                 A.append(a_root + a_close)
                 A.append(a_further)
         A = np.stack(A)
-        self.As.append(A)
+        return A
             
 
 
 def get_hop_distance(num_node, edge, lvl, max_hop=1):
-    A = np.zeros((num_node[lvl], num_node[lvl]))
-    for i, j in edge[lvl]:
-        A[j, i] = 1
-        A[i, j] = 1
+    A = np.zeros((num_node[lvl], num_node[lvl]), dtype=bool)
+    A[edge[lvl][:, 0], edge[lvl][:, 1]] = True
+    A[edge[lvl][:, 1], edge[lvl][:, 0]] = True
+
+    if max_hop == 1:  # Only configuration in use, hop distances are the adjacency itself
+        hop_dis = np.where(A, 1., np.inf)
+        np.fill_diagonal(hop_dis, 0)
+        return hop_dis
 
-    # compute hop steps
+    # compute hop steps, expanding the reachable nodes one hop at a time (BFS)
     hop_dis = np.zeros((num_node[lvl], num_node[lvl])) + np.inf
-    transfer_mat = [np.linalg.matrix_power(A, d) for d in range(max_hop + 1)]
-    arrive_mat = (np.stack(transfer_mat) > 0)
-    for d in range(max_hop, -1, -1):
-        hop_dis[arrive_mat[d]] = d
+    arrive  = np.eye(num_node[lvl], dtype=bool)
+    hop_dis[arrive] = 0
+    for d in range(1, max_hop + 1):
+        arrive = arrive @ A
+        hop_dis[arrive & np.isinf(hop_dis)] = d
     return hop_dis
 
 
 def normalize_digraph(A):
     Dl = np.sum(A, 0)
-    num_node = A.shape[0]
-    Dn = np.zeros((num_node, num_node))
-    for i in range(num_node):
-        if Dl[i] > 0:
-            Dn[i, i] = Dl[i]**(-1)
-    AD = np.dot(A, Dn)
+    Dn = np.zeros(Dl.shape)  # Float even for int/bool adjacencies
+    np.divide(1.0, Dl, out=Dn, where=Dl > 0)
+    AD = A * Dn[None, :]  # Same as A @ diag(Dn)
     return AD
 
 
 def normalize_undigraph(A):
     Dl = np.sum(A, 0)
-    num_node = A.shape[0]
-    Dn = np.zeros((num_node, num_node))
-    for i in range(num_node):
-        if Dl[i] > 0:
-            Dn[i, i] = Dl[i]**(-0.5)
-    DAD = np.dot(np.dot(Dn, A), Dn)
+    Dn = np.zeros(Dl.shape)  # Float even for int/bool adjacencies
+    np.power(Dl, -0.5, out=Dn, where=Dl > 0)
+    DAD = A * Dn[:, None] * Dn[None, :]  # Same as diag(Dn) @ A @ diag(Dn)
     return DAD
 
 def upsample_mapping(mapping, nodes, edges, lvls):
@@ -202,3 +194,17 @@ def upsample_mapping(mapping, nodes, edges, lvls):
         i-=1
 
     return all_hoods
+
+
+def upsample_matrix(mapping, num_node):
+    # Linear map upsampling a level from the level below, (V_low, V_high): kept nodes
+    # are carried over and every inserted node is the mean of its neighbours
+    n_low = num_node - len(mapping)
+    W     = np.zeros((n_low, num_node), dtype=np.float32)
+
+    inserted = [umap[0] for umap in mapping]
+    W[np.arange(n_low), np.setdiff1d(np.arange(num_node), inserted)] = 1
+    for umap in mapping:
+        W[umap[1:], umap[0]] = 1 / (len(umap)-1)
+
+    return W